@@ -1,2 +1,3 @@
 from .llm_provider import LLMProvider
 from .prompt_handler import PromptHandler
+from .micro_batcher import MicroBatcher
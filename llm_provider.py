@@ -1,13 +1,40 @@
 """
 llm_provider module provides interface to interact with different LLM providers 
-(Openai and Huuging face as of now). It includes utilities for handling prompts,
+(Openai, Huuging face and vLLM as of now). It includes utilities for handling prompts,
 processing data row-by-row or in chunks, and managing token limits
 """
 
-from openai import OpenAI
+import asyncio
+import bisect
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
+
+from aiolimiter import AsyncLimiter
+import diskcache
+import httpx
+from openai import OpenAI, AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, RateLimitError
 import pandas as pd
-from transformers import pipeline
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+import tiktoken
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
 from prompt_handler import PromptHandler
+from micro_batcher import MicroBatcher
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(model:str):
+    """Load the tiktoken encoding for a model once, falling back to cl100k_base for unknown models."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
 
 class LLMProvider:
     """
@@ -18,22 +45,43 @@ class LLMProvider:
       api_key(str) : Api key for accessing llm provider
       prompt_template(str) : Template to format prompts
       max_tokens (int) : maximum token limit for prompt
-      hf_model (str) : hugging face model name, required if provider is hugging face default None
+      hf_model (str) : hugging face model name, required if provider is hugging face or vllm default None
+      concurrency (int) : maximum number of requests in flight for the async methods and process_row_by_row
+      batch_size (int) : number of prompts per forward pass for hugging face batched inference
+      device (int or str) : device the hugging face model is loaded on, None to let accelerate place it
+      tokenizer : fast tokenizer of the hugging face model, None unless provider is hugging face or vllm
+      model : hugging face causal language model, None unless provider is hugging face
+      quantization (str) : weight quantization of the hugging face model, 'int8', 'nf4' or None
+      llm (vllm.LLM) : vLLM engine, None unless provider is vllm
+      batcher (MicroBatcher) : groups concurrent aquery calls into batches, set if provider is hugging face or vllm
+      cache (diskcache.Cache) : on-disk cache of responses keyed by prompt, None if caching is disabled
+      rpm (int) : maximum number of requests per minute sent by aprocess_row_by_row, None for no limit
     
     """
 
-    def __init__(self,provider:str,prompt_template:str,api_key=None,max_model_token=None,max_tokens=None,open_ai_model="gpt-3.5-turbo-instruct",hf_model=None):
+    def __init__(self,provider:str,prompt_template:str,api_key=None,max_model_token=None,max_tokens=None,open_ai_model="gpt-3.5-turbo-instruct",hf_model=None,concurrency=8,batch_size=8,device=None,batch_timeout=0.01,enable_cache=False,cache_dir=None,rpm=None,quantization=None):
         
         """
         Initializes the LLMProvider class.
 
         Args:
-            provider (str): Name of the LLM provider ('openai' or 'huggingface').
+            provider (str): Name of the LLM provider ('openai', 'huggingface' or 'vllm').
             api_key (str): API key for accessing the LLM provider.
             prompt_template (str): Template to format prompts.
             max_tokens (int): Maximum token limit for prompt.
             open_ai_model : open ai model  to be used if provider is openai. Default model is "gpt-3.5-turbo-instruct"
-            hf_model (str, optional): Hugging Face model name, required if provider is 'huggingface'.
+            hf_model (str, optional): Hugging Face model name, required if provider is 'huggingface' or 'vllm'.
+            concurrency (int, optional): Maximum number of concurrent requests used by the async methods and
+                process_row_by_row. Default 8, 1 disables threading in process_row_by_row.
+            batch_size (int, optional): Number of prompts per forward pass when provider is 'huggingface'. Default 8.
+            device (int or str, optional): Device for the Hugging Face model, e.g. 0 for the first GPU.
+                Default None, which places the model on the available GPUs with device_map="auto".
+            batch_timeout (float, optional): Maximum seconds aquery waits for other prompts to fill a Hugging Face batch. Default 0.01.
+            enable_cache (bool, optional): Reuse stored responses for prompts that were already queried. Default False.
+            cache_dir (str, optional): Directory of the response cache, a temporary directory if None.
+            rpm (int, optional): Maximum number of requests per minute sent by aprocess_row_by_row. Default None (no limit).
+            quantization (str, optional): Load the Hugging Face model with bitsandbytes 'int8' or 4-bit 'nf4' weights.
+                Ignored when running on CPU. Default None (bfloat16 weights).
         """
 
         self.provider=provider
@@ -42,15 +90,95 @@ class LLMProvider:
         self.max_tokens=max_tokens
         self.open_ai_model=open_ai_model
         self.hf_model=hf_model
+        self.concurrency=concurrency
+        self.batch_size=batch_size
+        self.device=device
         self.prompt_handler=PromptHandler(prompt_template)
+        self._executor=None
+        self.cache=diskcache.Cache(cache_dir) if enable_cache else None
+        self.rpm=rpm
+        self.quantization=quantization
         
-        #initialise huggingface pipline if provider is huggingface
+        #initialise huggingface tokenizer and model if provider is huggingface
+        self.tokenizer=None
+        self.model=None
         if self.provider=="huggingface" and self.hf_model:
-             self.hf_pipeline=pipeline('text-generation',model=hf_model)
+             #decoder-only models continue from the right, so batches are padded on the left
+             self.tokenizer=AutoTokenizer.from_pretrained(hf_model,use_fast=True,padding_side="left")
+             #batched generation needs a pad token, most causal models only define eos
+             if self.tokenizer.pad_token_id is None:
+                  self.tokenizer.pad_token=self.tokenizer.eos_token
+             self.model=AutoModelForCausalLM.from_pretrained(hf_model,torch_dtype=torch.bfloat16,
+                                                             device_map="auto" if device is None else device,
+                                                             quantization_config=self._quantization_config())
+             self.model.eval()
+             self.batcher=MicroBatcher(self._query_huggingface_batch,max_batch_size=batch_size,timeout=batch_timeout)
+
+        #initialise vllm engine if provider is vllm, it batches continuously with paged attention
+        self.llm=None
+        if self.provider=="vllm" and self.hf_model:
+             try:
+                  from vllm import LLM, SamplingParams
+             except ImportError as e:
+                  raise ImportError("provider 'vllm' requires the vllm package, install it with: pip install vllm") from e
+             self.llm=LLM(model=hf_model,dtype="bfloat16",gpu_memory_utilization=0.9)
+             self.tokenizer=self.llm.get_tokenizer()
+             self._sampling_params=SamplingParams(max_tokens=self.max_model_token,truncate_prompt_tokens=self.max_tokens)
+             #the engine is not thread safe, every generate call holds this lock
+             self._llm_lock=threading.Lock()
+             #async callers share batches from a single worker
+             self.batcher=MicroBatcher(self._query_vllm_batch,max_batch_size=batch_size,timeout=batch_timeout)
+
+        #initialise openai clients once if provider is openai, so connections are kept alive between calls
+        #http2 multiplexes concurrent requests over a few connections instead of one handshake per request
+        if self.provider=="openai":
+             limits=httpx.Limits(max_connections=concurrency,max_keepalive_connections=concurrency)
+             self._client=OpenAI(api_key=api_key,http_client=DefaultHttpxClient(http2=True,limits=limits))
+             self._aclient=AsyncOpenAI(api_key=api_key,http_client=DefaultAsyncHttpxClient(http2=True,limits=limits))
         
+    def close(self):
+        """
+        Release the thread pool, the OpenAI connection pool and the response cache.
+        """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor=None
+        if self.provider=="openai":
+            self._client.close()
+        if self.cache is not None:
+            self.cache.close()
+
+    async def aclose(self):
+        """
+        Close the async OpenAI connection pool, then release everything close() does.
+        """
+        if self.provider=="openai":
+            await self._aclient.close()
+        self.close()
+
+    def _quantization_config(self):
+        """
+        Build the bitsandbytes config for the requested quantization.
+
+        Returns:
+            BitsAndBytesConfig: Config for from_pretrained, None if no quantization was requested
+            or the model runs on CPU, where bitsandbytes kernels are not available.
+        """
+        if self.quantization is None:
+            return None
+        if self.quantization == "int8":
+            config = BitsAndBytesConfig(load_in_8bit=True)
+        elif self.quantization == "nf4":
+            config = BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_quant_type="nf4", bnb_4bit_compute_dtype=torch.bfloat16)
+        else:
+            raise ValueError(f"Unsupported quantization: {self.quantization}")
+        if self.device == "cpu" or not torch.cuda.is_available():
+            return None
+        return config
+
     def query(self, prompt: str):
         """
-        Query the respective LLM provider (OpenAI or Hugging Face).
+        Query the respective LLM provider (OpenAI, Hugging Face or vLLM).
 
         Args:
             prompt (str): Input prompt to query the LLM.
@@ -60,12 +188,85 @@ class LLMProvider:
         
         """
 
+        cached = self._cache_get(prompt)
+        if cached is not None:
+            return cached
+
         if self.provider == "openai":
-            return self._query_openai(prompt)
+            response = self._query_openai(prompt)
         elif self.provider == "huggingface":
-            return self._query_huggingface(prompt)
+            response = self._query_huggingface(prompt)
+        elif self.provider == "vllm":
+            response = self._query_vllm_batch([prompt])[0]
+        else:
+            raise ValueError(f"Unsupported provider: {self.provider}")
+        self._cache_set(prompt, response)
+        return response
+
+    async def aquery(self, prompt: str):
+        """
+        Asynchronously query the respective LLM provider (OpenAI, Hugging Face or vLLM).
+
+        Args:
+            prompt (str): Input prompt to query the LLM.
+
+        Returns:
+            str: Response generated by the LLM.
+        """
+
+        cached = self._cache_get(prompt)
+        if cached is not None:
+            return cached
+
+        if self.provider == "openai":
+            response = await self._aquery_openai(prompt)
+        elif self.provider in ("huggingface", "vllm"):
+            #concurrent calls are grouped into one batched generate call
+            response = await self.batcher.submit(prompt)
         else:
             raise ValueError(f"Unsupported provider: {self.provider}")
+        self._cache_set(prompt, response)
+        return response
+
+    def _cache_key(self, prompt: str):
+        """
+        Key of a prompt in the response cache. Includes everything that changes the response.
+
+        Args:
+            prompt (str): Input prompt.
+
+        Returns:
+            str: sha256 hex digest identifying the prompt and generation settings.
+        """
+        model = self.open_ai_model if self.provider == "openai" else self.hf_model
+        #max_tokens truncates hugging face and vllm prompts, quantization changes the model's weights
+        settings = f"{self.provider}|{model}|{self.max_model_token}|{self.max_tokens}|{self.quantization}"
+        return hashlib.sha256(f"{settings}|{prompt}".encode()).hexdigest()
+
+    def _cache_get(self, prompt: str):
+        """
+        Look up a stored response.
+
+        Args:
+            prompt (str): Input prompt.
+
+        Returns:
+            str: The stored response, None if caching is disabled or the prompt was not queried before.
+        """
+        if self.cache is None:
+            return None
+        return self.cache.get(self._cache_key(prompt))
+
+    def _cache_set(self, prompt: str, response: str):
+        """
+        Store a response, if caching is enabled.
+
+        Args:
+            prompt (str): Input prompt.
+            response (str): Response generated for the prompt.
+        """
+        if self.cache is not None:
+            self.cache[self._cache_key(prompt)] = response
 
     def _query_openai(self, prompt: str):
         """
@@ -76,8 +277,23 @@ class LLMProvider:
         Returns:
             str: Response generated by OpenAI.
             """
-        client=OpenAI(api_key=self.api_key)
-        response = client.Completion.create(
+        response = self._client.completions.create(
+            model=self.open_ai_model,
+            prompt=prompt,
+            max_tokens=self.max_model_token
+        )
+        return response.choices[0].text.strip()
+
+    async def _aquery_openai(self, prompt: str):
+        """
+        Asynchronously query OpenAI for a response.
+         Args:
+            prompt (str): Input prompt to query the OpenAI LLM.
+
+        Returns:
+            str: Response generated by OpenAI.
+            """
+        response = await self._aclient.completions.create(
             model=self.open_ai_model,
             prompt=prompt,
             max_tokens=self.max_model_token
@@ -93,56 +309,241 @@ class LLMProvider:
         Returns:
             str: Response generated by OpenAI.
             """
-        if not self.hf_pipeline:
-            raise ValueError("Hugging Face pipeline is not initialized. Please provide a valid Hugging Face model.")
-        response = self.hf_pipeline(prompt, max_length=self.max_model_token, truncation=True)
-        return response[0]["generated_text"]
-
-    def _convert_to_dicts(self,rows):
-        """If input is Pandas Data frame converts it to dictionary,
-           If Pandas Series converts it to list.
+        return self.batched_generate([prompt])[0]
+
+    def _query_huggingface_batch(self, prompts: list):
+        """
+        Query Hugging Face for a list of prompts, generating batch_size prompts at a time.
+        Args:
+            prompts (list): Input prompts to query the Hugging Face LLM.
+
+        Returns:
+            list: Response generated for each prompt, in input order.
+            """
+        results = [self._cache_get(prompt) for prompt in prompts]
+        missing = [i for i, result in enumerate(results) if result is None]
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start+self.batch_size]
+            for i, response in zip(batch, self.batched_generate([prompts[i] for i in batch])):
+                results[i] = response
+                self._cache_set(prompts[i], response)
+        return results
+
+    def _query_vllm_batch(self, prompts: list):
+        """
+        Query vLLM for a list of prompts in a single generate call, vLLM schedules the batching itself.
+        Args:
+            prompts (list): Input prompts to query the vLLM engine.
+
+        Returns:
+            list: Generated completion for each prompt, without the prompt, in input order.
+            """
+        if self.llm is None:
+            raise ValueError("vLLM engine is not initialized. Please provide a valid Hugging Face model.")
+        results = [self._cache_get(prompt) for prompt in prompts]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            with self._llm_lock:
+                outputs = self.llm.generate([prompts[i] for i in missing], self._sampling_params, use_tqdm=False)
+            for i, output in zip(missing, outputs):
+                results[i] = output.outputs[0].text
+                self._cache_set(prompts[i], results[i])
+        return results
+
+    def batched_generate(self, prompts: list):
+        """
+        Generate responses for a list of prompts with a single tokenizer call and a single
+        greedy generate call.
+
+        Prompts are truncated to max_tokens and up to max_model_token new tokens are generated.
+
+        Args:
+            prompts (list): Input prompts to query the Hugging Face LLM.
+
+        Returns:
+            list: Generated text for each prompt, including the prompt, in input order.
+            """
+        if self.model is None:
+            raise ValueError("Hugging Face model is not initialized. Please provide a valid Hugging Face model.")
+        inputs = self.tokenizer(prompts, return_tensors="pt", padding=True,
+                                truncation=self.max_tokens is not None, max_length=self.max_tokens).to(self.model.device)
+        with torch.inference_mode():
+            outputs = self.model.generate(**inputs, max_new_tokens=self.max_model_token, do_sample=False, use_cache=True,
+                                          pad_token_id=self.tokenizer.pad_token_id)
+        return self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
+
+    def _get_executor(self):
+        """Create the thread pool used by process_row_by_row on first use and reuse it afterwards."""
+        if self._executor is None:
+            self._executor=ThreadPoolExecutor(max_workers=self.concurrency)
+        return self._executor
+
+    def _iter_rows_df(self,df):
+        """Yield the rows of a data frame one at a time as dictionaries.
+           itertuples reads the columns lazily, so the frame is never copied into a list of records.
+           args:
+            df (pd.DataFrame): Input data.
+
+           Yields:
+            dict: Column name mapped to value for each row.
+        """
+        cols=df.columns.tolist()
+        for row in df.itertuples(index=False,name=None):
+            yield dict(zip(cols,row))
+
+    def _iter_prompts(self,rows):
+        """Lazily generate the prompt for every row of the input.
            args:
             rows (pd.DataFrame or pd.Series): Input data.
 
            Returns:
-            list: List of dictionaries or list of values.
+            iterator: Prompts, one per row, generated as they are consumed.
         """
-        #if data frame converts it to dictionary
         if isinstance(rows,pd.DataFrame):
-            return rows.to_dict(orient='records')
-        elif isinstance(rows,pd.Series): #if series converts to list
-             return list(rows)
+            return (self.prompt_handler.generate_prompt_df(row) for row in self._iter_rows_df(rows))
+        elif isinstance(rows,pd.Series):
+             return (self.prompt_handler.generate_prompt_srs(row) for row in rows)
         else:
-             raise TypeError("Pass either pandas Data Frame or pandas Series")
+             raise TypeError("Input should be of type Pandas DataFrame or Series")
     
-    def process_row_by_row(self, rows):
+    def _iter_responses(self, prompts):
+        """
+        Query the LLM for each prompt, yielding responses in input order as they become available.
+
+        Args:
+            prompts (iterable): Prompts, consumed lazily except by vllm which needs all of them at once.
+
+        Yields:
+            str: Response generated for each prompt.
+        """
+        #hugging face generates the prompts in batches instead of one call per row
+        if self.provider == "huggingface":
+            prompts = iter(prompts)
+            while True:
+                batch = list(islice(prompts, self.batch_size))
+                if not batch:
+                    break
+                yield from self._query_huggingface_batch(batch)
+        elif self.provider == "vllm":
+            yield from self._query_vllm_batch(list(prompts))
+        #api calls wait on the network, so run them on a thread pool; map keeps the input order
+        elif self.concurrency > 1:
+            yield from self._get_executor().map(self.query, prompts)
+        else:
+            for prompt in prompts:
+                yield self.query(prompt)
+
+    def _load_checkpoint(self, output_jsonl):
+        """
+        Read the rows already answered in a checkpoint file.
+
+        Args:
+            output_jsonl (str): Path of the checkpoint file.
+
+        Returns:
+            dict: Row index mapped to its (prompt, response) tuple, empty if the file does not exist.
+        """
+        done = {}
+        if not os.path.exists(output_jsonl):
+            return done
+        line = ""
+        with open(output_jsonl, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:  # a line cut short by an interrupted run
+                    continue
+                done[record["idx"]] = (record["prompt"], record["response"])
+        #terminate a cut short last line so the next record starts on its own line
+        if line and not line.endswith("\n"):
+            with open(output_jsonl, "a", encoding="utf-8") as f:
+                f.write("\n")
+        return done
+
+    def process_row_by_row(self, rows, output_jsonl=None):
             """
             Process input row-by-row. This method generates a prompt for each row 
             and queries the LLM for a response.
 
+            If output_jsonl is given, every response is appended to that file as soon as it
+            arrives, and rows already in the file from an earlier run are not queried again.
+
             Args :
                  rows (pandas series or dataframe) : Input data
+                 output_jsonl (str, optional) : Path of a JSON lines checkpoint file. Default None
 
             Out put :
                     List : List of Response generated by for each row
             """
 
-            if isinstance(rows,pd.DataFrame):
-                    rows = self._convert_to_dicts(rows)
-                    results = []
-                    for row in rows:
-                        prompt = self.prompt_handler.generate_prompt_df(**row)  # Use prompt_handler to generate the prompt
-                        results.append(self.query(prompt))  # Query with the generated prompt
-                    return results
-            elif isinstance(rows,pd.Series):
-                    rows = self._convert_to_dicts(rows)
-                    results = []
-                    for row in rows:
-                        prompt = self.prompt_handler.generate_prompt_srs(row)  # Use prompt_handler to generate the prompt
-                        results.append(self.query(prompt))  # Query with the generated prompt
-                    return results
-            else:
-                 raise TypeError("Input should be of type Pandas DataFrame or Series")
+            prompts = self._iter_prompts(rows)  # Use prompt_handler to generate the prompts
+            if output_jsonl is None:
+                 return list(self._iter_responses(prompts))  # Query with the generated prompts
+
+            #a row is only reused if its prompt is unchanged since the checkpoint was written
+            done = self._load_checkpoint(output_jsonl)
+            results = []
+            pending = []
+            for idx, prompt in enumerate(prompts):
+                 if idx in done and done[idx][0] == prompt:
+                      results.append(done[idx][1])
+                 else:
+                      results.append(None)
+                      pending.append((idx, prompt))
+
+            with open(output_jsonl, "a", encoding="utf-8") as f:
+                 responses = self._iter_responses(prompt for _, prompt in pending)
+                 for (idx, prompt), response in zip(pending, responses):
+                      f.write(json.dumps({"idx": idx, "prompt": prompt, "response": response}) + "\n")
+                      f.flush()
+                      results[idx] = response
+            return results
+
+    async def aprocess_row_by_row(self, rows):
+            """
+            Asynchronously process input row-by-row. A prompt is generated for each row
+            and all rows are queried concurrently, with at most `concurrency` requests in flight
+            and at most `rpm` requests per minute. Rate limited requests are retried with backoff.
+
+            Args :
+                 rows (pandas series or dataframe) : Input data
+
+            Out put :
+                    List : List of Response generated for each row, in input order
+            """
+
+            prompts = list(self._iter_prompts(rows))
+
+            if self.provider == "huggingface":
+                 return await asyncio.to_thread(self._query_huggingface_batch, prompts)
+            if self.provider == "vllm":
+                 return await asyncio.to_thread(self._query_vllm_batch, prompts)
+
+            #built per call, like the semaphore, since both bind to the running event loop
+            sem = asyncio.Semaphore(self.concurrency)
+            limiter = AsyncLimiter(self.rpm, 60) if self.rpm else None
+            return await asyncio.gather(*[self._bounded_query(sem, limiter, prompt) for prompt in prompts])
+
+    async def _bounded_query(self, sem, limiter, prompt: str):
+        """
+        Query the LLM holding a slot of the semaphore, within the requests per minute limit.
+        Rate limit errors are retried with random exponential backoff, up to 6 attempts.
+
+        Args:
+            sem (asyncio.Semaphore): Semaphore bounding the number of requests in flight.
+            limiter (AsyncLimiter): Limiter for the requests per minute, None for no limit.
+            prompt (str): Input prompt to query the LLM.
+
+        Returns:
+            str: Response generated by the LLM.
+        """
+        async with sem:
+            async for attempt in AsyncRetrying(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6),
+                                               retry=retry_if_exception_type(RateLimitError), reraise=True):
+                with attempt:
+                    if limiter is not None:
+                        await limiter.acquire()
+                    return await self.aquery(prompt)
     
     def process_in_one_big_chunk(self,rows):
             """
@@ -155,22 +556,10 @@ class LLMProvider:
         Returns:
             str: Response generated by the LLM for the combined prompt.
             """
-            if isinstance(rows,pd.DataFrame):          
-                    rows=self._convert_to_dicts(rows)
-                    formated_rows=[self.prompt_handler.generate_prompt_df(**row) for row in rows]
-                    prompts="\n".join(formated_rows)
-                    if self.count_tokens(prompts)>self.max_tokens:
-                        raise ValueError("Total prompt exceeds the maximum token limit")            
-                    return self.querry(prompts)
-            elif isinstance(rows,pd.Series):
-                    rows=self._convert_to_dicts(rows)
-                    formated_rows=[self.prompt_handler.generate_prompt_srs(row) for row in rows]
-                    prompts="\n".join(formated_rows)
-                    if self.count_tokens(prompts)>self.max_tokens:
-                        raise ValueError("Total prompt exceeds the maximum token limit")            
-                    return self.querry(prompts)             
-            else:
-                 raise TypeError("Input should be of type Pandas DataFrame or Series")
+            prompts="\n".join(self._iter_prompts(rows))
+            if self.count_tokens(prompts)>self.max_tokens:
+                raise ValueError("Total prompt exceeds the maximum token limit")            
+            return self.query(prompts)
     
     def process_in_chunks(self,rows):
         """
@@ -185,67 +574,88 @@ class LLMProvider:
         """
         
 
-        def make_chunks(prompts,max_tokens):
+        def make_chunks(lengths,max_tokens,sep_len):
             """
-            Split prompts into chunks based on the maximum token limit.
+            Pack prompts into as few chunks as possible within the maximum token limit
+            using best-fit-decreasing. Prompts keep their input order inside a chunk
+            and chunks are ordered by their first prompt.
 
             Args:
-                prompts (list): List of prompt strings.
+                lengths (list): Token count of each prompt, computed beforehand in one batch.
                 max_tokens (int): Maximum token limit for each chunk.
+                sep_len (int): Token count of the separator placed between two prompts of a chunk.
 
             Returns:
-                list: List of chunks.
+                list: List of chunks, each a list of prompt indices.
             """
-            chunks=[]
-            sub_chunks=[]
-            token=0
+            #a chunk of k prompts holds k-1 separators, so charge each prompt one separator
+            #and give every chunk room for one extra
+            capacity=max_tokens+sep_len
+            bins=[]  #row indices in each chunk
+            space=[]  #sorted (tokens left, chunk index) of the chunks that still have room
 
-            for prompt in prompts:
-                prompt_len = self.count_tokens(prompt)
-                if prompt_len+token<=max_tokens:
-                            sub_chunks.append(prompt)
-                            token+=prompt_len
-                else: 
-                    chunks.append("\n".join(sub_chunks))
-                    sub_chunks=[prompt]
-                    token=prompt_len
-            
-            #if any sub chunks are left over
-            if sub_chunks:
-                chunks.append("\n".join(sub_chunks))
-        
-        if isinstance(rows,pd.DataFrame):
-            rows=self._convert_to_dicts(rows)
-            prompts=[self.prompt_handler.generate_prompt_df(**row) for row in rows]
-            chunks=make_chunks(prompts,self.max_tokens)
-            results=[]
-            for chunk in chunks:
-                 result=self.query(chunk)
-                 result.append(result)
-            return results
-        
-        elif isinstance(rows,pd.Series):
-            rows= self._convert_to_dicts(rows)
-            prompts=[self.prompt_handler.generate_prompt_srs(row) for row in rows]
-            chunks=make_chunks(prompts)
-            results=[]
-            for chunk in chunks:
-                 result=self.query(chunk)
-                 results.append(result)
-            return results
+            #longest prompts first, each into the chunk with the least room that still fits it
+            order=sorted(range(len(lengths)),key=lengths.__getitem__,reverse=True)
+            for i in order:
+                prompt_len=lengths[i]+sep_len
+                pos=bisect.bisect_left(space,(prompt_len,-1))
+                if pos<len(space):
+                    left,b=space.pop(pos)
+                    bins[b].append(i)
+                    bisect.insort(space,(left-prompt_len,b))
+                else:
+                    bins.append([i])
+                    if prompt_len<=capacity: #a prompt over the limit gets a chunk of its own
+                        bisect.insort(space,(capacity-prompt_len,len(bins)-1))
+
+            return sorted(sorted(b) for b in bins)
         
-        else:
-             raise TypeError("Input should be of type Pandas DataFrame or Pandas Series")
+        prompts=list(self._iter_prompts(rows))
+        if not prompts:
+            return []
+        lengths=self.count_tokens(prompts)  #one batched tokenizer call for all prompts
+        pending=make_chunks(lengths,self.max_tokens,self.count_tokens("\n"))
+
+        #tokens can merge or split where prompts are joined, so count each joined chunk once more
+        #and halve the rare chunk that still exceeds the limit, a truncated chunk would lose rows
+        chunks=[]
+        while pending:
+            joined=["\n".join(prompts[i] for i in b) for b in pending]
+            too_long=[]
+            for b,chunk,chunk_len in zip(pending,joined,self.count_tokens(joined)):
+                if chunk_len<=self.max_tokens or len(b)==1:
+                    chunks.append((b[0],chunk))
+                else:
+                    too_long+=[b[:len(b)//2],b[len(b)//2:]]
+            pending=too_long
+        chunks=[chunk for _,chunk in sorted(chunks)]
+
+        results=[]
+        for chunk in chunks:
+             result=self.query(chunk)
+             results.append(result)
+        return results
                           
-    def count_tokens(self,text:str):
+    def count_tokens(self,text):
         """
-        Count the number of tokens in the given text.
+        Count the number of tokens in the given text. Uses the model's own fast tokenizer for
+        hugging face and vllm, and the tiktoken encoding of open_ai_model otherwise.
+        A list of texts is encoded in one batched call.
 
         Args:
-            text (str): Input text.
+            text (str or list): Input text or list of texts.
 
         Returns:
-            int: Number of tokens in the text.
+            int or list: Number of tokens in the text, or a list of counts for a list of texts.
         """
-        return len(text.split())
-
+        if self.tokenizer is not None:
+            texts=[text] if isinstance(text,str) else list(text)
+            if not texts:  #fast tokenizers raise IndexError on an empty batch
+                return []
+            lengths=self.tokenizer(texts,add_special_tokens=False,return_length=True)["length"]
+            return lengths[0] if isinstance(text,str) else lengths
+        encoding=_get_encoding(self.open_ai_model)
+        if isinstance(text,str):
+            return len(encoding.encode(text,disallowed_special=()))
+        encoded=encoding.encode_batch(list(text),num_threads=os.cpu_count(),disallowed_special=())
+        return [len(tokens) for tokens in encoded]
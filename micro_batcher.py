@@ -0,0 +1,106 @@
+"""
+Contain class for grouping prompts submitted concurrently into batches
+that are sent to the model in a single call
+"""
+
+import asyncio
+
+
+class MicroBatcher:
+    """
+    A utility class that collects prompts submitted from concurrent coroutines and
+    dispatches them together.
+
+    A batch is flushed as soon as max_batch_size prompts are waiting or timeout seconds
+    have passed since the first prompt of the batch arrived, so a lone request is
+    delayed by at most timeout.
+
+    Attributes:
+        batch_fn (callable): Blocking function mapping a list of prompts to a list of responses.
+        max_batch_size (int): Maximum number of prompts per batch.
+        timeout (float): Maximum time in seconds to wait for a batch to fill.
+    """
+
+    def __init__(self, batch_fn, max_batch_size: int = 8, timeout: float = 0.01):
+        """
+        Initialize the MicroBatcher.
+
+        Args:
+            batch_fn (callable): Blocking function mapping a list of prompts to a list of responses.
+                It is run in a worker thread so the event loop keeps accepting prompts.
+            max_batch_size (int, optional): Maximum number of prompts per batch. Default 8.
+            timeout (float, optional): Maximum time in seconds to wait for a batch to fill. Default 0.01.
+        """
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+        self._loop = None
+        self._queue = None
+        self._worker = None
+
+    async def submit(self, prompt: str):
+        """
+        Queue a prompt for the next batch and wait for its response.
+
+        Args:
+            prompt (str): Input prompt.
+
+        Returns:
+            str: Response generated for the prompt.
+        """
+        self._ensure_worker()
+        future = self._loop.create_future()
+        await self._queue.put((prompt, future))
+        return await future
+
+    def _ensure_worker(self):
+        """
+        Start the background batching task on the running event loop, restarting it
+        if the batcher is used from a new loop (e.g. successive asyncio.run calls).
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._worker.done():
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+
+    async def _collect_batch(self):
+        """
+        Wait for the first prompt, then keep collecting until the batch is full
+        or the timeout expires.
+
+        Returns:
+            list: List of (prompt, future) tuples.
+        """
+        batch = [await self._queue.get()]
+        deadline = self._loop.time() + self.timeout
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        """
+        Background loop dispatching each collected batch with batch_fn.
+        """
+        while True:
+            batch = await self._collect_batch()
+            prompts = [prompt for prompt, _ in batch]
+            try:
+                responses = await asyncio.to_thread(self.batch_fn, prompts)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for (_, future), response in zip(batch, responses):
+                    if not future.done():
+                        future.set_result(response)
@@ -2,6 +2,8 @@
 Contain class for generating prompt using given template and data
 """
 
+import string
+
 class PromptHandler:
     """
     A utility class to handle prompt generation using a specified template.
@@ -21,18 +23,40 @@ class PromptHandler:
             prompt_template (str): Template string with placeholders for formatting.
         """
         self.prompt_template = prompt_template
+        #named fields of the template, parsed once; only their values can change a row's prompt
+        self._fields = self._parse_fields(prompt_template)
+
+    @staticmethod
+    def _parse_fields(prompt_template: str):
+        """
+        List the distinct named fields of a template, e.g. 'name' for both {name} and {name.upper}.
+
+        Args:
+            prompt_template (str): Template string with placeholders for formatting.
+
+        Returns:
+            tuple: Field names in order of first appearance.
+        """
+        fields = {}
+        for _, field_name, format_spec, _ in string.Formatter().parse(prompt_template):
+            if field_name and not field_name.isdigit():
+                fields[field_name.split(".", 1)[0].split("[", 1)[0]] = None
+            if format_spec:  # nested fields such as {value:{width}}
+                fields.update(dict.fromkeys(PromptHandler._parse_fields(format_spec)))
+        return tuple(fields)
 
-    def generate_prompt_df(self, **kwargs):
+    def generate_prompt_df(self, row):
         """
         Generate a prompt from a dictionary-like input, typically a row from a DataFrame.
 
         Args:
-            **kwargs: Key-value pairs that correspond to the placeholders in the prompt template.
+            row (Mapping): Key-value pairs that correspond to the placeholders in the prompt template.
+                Keys that are not used by the template are ignored.
 
         Returns:
             str: The generated prompt based on the input data.
         """
-        return self.prompt_template.format(**kwargs)
+        return self.prompt_template.format_map(row)
 
     def generate_prompt_srs(self, args):
         """
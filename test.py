@@ -1,10 +1,279 @@
+import asyncio
+import random
+import threading
+import time
+from decimal import Decimal
+from types import MappingProxyType, SimpleNamespace
+
+import httpx
 import pandas as pd
+import pytest
+import tenacity
+from openai import RateLimitError
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import PreTrainedTokenizerFast
+import llm_provider
 from llm_provider import LLMProvider
+from micro_batcher import MicroBatcher
+from prompt_handler import PromptHandler
+
+
+SALARY_TEMPLATE='Given the salary of {salary}, what is the square of the salary?'
+
+
+@pytest.fixture
+def queried():
+    """Prompts the stubbed query was called with, in call order."""
+    return []
+
+
+@pytest.fixture
+def echo_provider(monkeypatch,queried):
+    """OpenAI provider whose query echoes the prompt back, with whitespace token counts, so no api or tokenizer download is needed."""
+    provider=LLMProvider(provider='openai',prompt_template=SALARY_TEMPLATE,api_key='test',max_tokens=50,concurrency=1)
+    def query(prompt):
+        queried.append(prompt)
+        return prompt
+    monkeypatch.setattr(provider,'query',query)
+    monkeypatch.setattr(provider,'count_tokens',
+                        lambda text: [len(t.split()) for t in text] if isinstance(text,list) else len(text.split()))
+    return provider
+
+
+@pytest.fixture
+def word_tokenizer_provider(monkeypatch,queried):
+    """Echo hugging face provider counting tokens with a real fast tokenizer that has one token per word."""
+    tokenizer=Tokenizer(models.WordLevel({'[UNK]':0},unk_token='[UNK]'))
+    tokenizer.pre_tokenizer=pre_tokenizers.Whitespace()
+    provider=LLMProvider(provider='huggingface',prompt_template='{}',max_tokens=10,concurrency=1)
+    def query(prompt):
+        queried.append(prompt)
+        return prompt
+    monkeypatch.setattr(provider,'tokenizer',PreTrainedTokenizerFast(tokenizer_object=tokenizer))
+    monkeypatch.setattr(provider,'query',query)
+    return provider
+
+
+@pytest.fixture
+def batch_sizes():
+    """Size of every batch the echo batch function received."""
+    return []
+
+
+@pytest.fixture
+def echo_batch_fn(batch_sizes):
+    """Batch function that upper-cases the prompts and records each batch size."""
+    def batch_fn(prompts):
+        batch_sizes.append(len(prompts))
+        return [prompt.upper() for prompt in prompts]
+    return batch_fn
+
+
+def test_process_in_chunks(echo_provider):
+    df=pd.DataFrame({'salary':range(1000),'emp_name':['emp']*1000})
+    prompts=[SALARY_TEMPLATE.format(salary=salary) for salary in range(1000)]
+
+    chunks=echo_provider.process_in_chunks(df)
+
+    #every prompt has 12 tokens, so 4 fit in each chunk and rows stay in order
+    assert len(chunks)==250
+    assert all(echo_provider.count_tokens(chunk)<=50 for chunk in chunks)
+    assert "\n".join(chunks).split("\n")==prompts
+
+
+def test_process_in_chunks_packs_mixed_lengths(word_tokenizer_provider):
+    word_counts=[6,2,5,4,3,12,5]
+    srs=pd.Series([' '.join([f'r{row}']*count) for row,count in enumerate(word_counts)])
+
+    chunks=word_tokenizer_provider.process_in_chunks(srs)
+
+    #best-fit-decreasing needs 4 chunks where splitting in input order needs 5, the 12 token row
+    #is over the limit and gets a chunk of its own
+    rows_per_chunk=[sorted({int(word[1:]) for word in chunk.split()}) for chunk in chunks]
+    assert rows_per_chunk==[[0,3],[1,4],[2,6],[5]]
+    assert all(word_tokenizer_provider.count_tokens(chunk)<=10 for chunk in chunks if chunk!=srs[5])
+
+
+def test_process_in_chunks_empty_input(word_tokenizer_provider,queried):
+    assert word_tokenizer_provider.process_in_chunks(pd.Series([],dtype=object))==[]
+    assert queried==[]
+
+
+def test_process_in_one_big_chunk(echo_provider):
+    df=pd.DataFrame({'salary':[2,3]})
+
+    assert echo_provider.process_in_one_big_chunk(df)==(SALARY_TEMPLATE.format(salary=2)+'\n'+
+                                                        SALARY_TEMPLATE.format(salary=3))
+
+
+def test_process_row_by_row_resumes_from_checkpoint(echo_provider,queried,tmp_path):
+    output_jsonl=str(tmp_path/"out.jsonl")
+    df=pd.DataFrame({'salary':[1,2,3]})
+
+    first=echo_provider.process_row_by_row(df,output_jsonl=output_jsonl)
+    assert len(queried)==3
+    queried.clear()
+
+    assert echo_provider.process_row_by_row(df,output_jsonl=output_jsonl)==first
+    assert queried==[]
+
+
+def test_process_row_by_row_requeries_truncated_and_changed_rows(echo_provider,queried,tmp_path):
+    output_jsonl=tmp_path/"out.jsonl"
+    echo_provider.process_row_by_row(pd.DataFrame({'salary':[1,2,3]}),output_jsonl=str(output_jsonl))
+    queried.clear()
+
+    #cut the record of the last row in half, as an interrupted run would leave it
+    content=output_jsonl.read_text()
+    output_jsonl.write_text(content[:len(content)-20])
+
+    results=echo_provider.process_row_by_row(pd.DataFrame({'salary':[7,2,3]}),output_jsonl=str(output_jsonl))
+
+    assert queried==[SALARY_TEMPLATE.format(salary=7),SALARY_TEMPLATE.format(salary=3)]
+    assert results==[SALARY_TEMPLATE.format(salary=salary) for salary in [7,2,3]]
+
+    #the records appended after the cut line are readable, so a third run queries nothing
+    queried.clear()
+    echo_provider.process_row_by_row(pd.DataFrame({'salary':[7,2,3]}),output_jsonl=str(output_jsonl))
+    assert queried==[]
+
+
+def test_parse_fields():
+    assert PromptHandler._parse_fields('{v:{width}} {a.attr} {d[k]} {{literal}} {v}')==('v','width','a','d')
+    assert PromptHandler._parse_fields('{} {0} {{x}}')==()
+
+
+def test_generate_prompt_df_takes_a_mapping():
+    handler=PromptHandler('{v:>{width}}|{a.attr}|{d[k]}|{{v}}')
+    row={'v':'x','width':3,'a':SimpleNamespace(attr='y'),'d':{'k':'z'},'unused':object()}
+
+    assert handler.generate_prompt_df(row)=='  x|y|z|{v}'
+    #any mapping works, not only a dict that could be expanded as keyword arguments
+    assert handler.generate_prompt_df(MappingProxyType(row))=='  x|y|z|{v}'
+    assert handler.generate_prompt_df(pd.Series({'v':1,'width':2,'a':SimpleNamespace(attr=2),'d':{'k':3}}))==' 1|2|3|{v}'
+
+
+def test_prompts_differ_for_equal_values_that_format_differently():
+    #each pair compares (and hashes) equal, but str.format renders them differently
+    pairs=[(0.0,-0.0),(1,1.0),(1,True),(Decimal('1.0'),Decimal('1.00')),
+           (pd.Timestamp('2024-01-01 12:00',tz='UTC'),pd.Timestamp('2024-01-01 13:00',tz='Europe/Paris'))]
+    df_handler=PromptHandler('value: {v}')
+    srs_handler=PromptHandler('value: {}')
+
+    for a,b in pairs:
+        assert [df_handler.generate_prompt_df({'v':v}) for v in (a,b)]==[f'value: {a}',f'value: {b}']
+        assert [srs_handler.generate_prompt_srs(v) for v in (a,b)]==[f'value: {a}',f'value: {b}']
+
+
+def test_iter_responses_keeps_input_order_on_thread_pool(echo_provider,monkeypatch):
+    rng=random.Random(0)
+    delays=[rng.uniform(0,0.02) for _ in range(64)]
+    lock=threading.Lock()
+    in_flight=[0]
+    max_in_flight=[0]
+    def query(prompt):
+        with lock:
+            in_flight[0]+=1
+            max_in_flight[0]=max(max_in_flight[0],in_flight[0])
+        time.sleep(delays[int(prompt)])
+        with lock:
+            in_flight[0]-=1
+        return prompt
+    monkeypatch.setattr(echo_provider,'concurrency',8)
+    monkeypatch.setattr(echo_provider,'query',query)
+
+    prompts=[str(i) for i in range(64)]
+    assert list(echo_provider._iter_responses(prompts))==prompts
+    #the queries overlapped, so they could finish out of input order
+    assert max_in_flight[0]>1
+    echo_provider.close()
+
+
+def test_response_cache_hits_repeated_prompts_and_misses_changed_settings(monkeypatch,queried,tmp_path):
+    provider=LLMProvider(provider='openai',prompt_template=SALARY_TEMPLATE,api_key='test',max_model_token=100,
+                         max_tokens=50,enable_cache=True,cache_dir=str(tmp_path))
+    def query_openai(prompt):
+        queried.append(prompt)
+        return prompt
+    monkeypatch.setattr(provider,'_query_openai',query_openai)
+
+    assert provider.query('p')=='p'
+    assert provider.query('p')=='p'
+    assert queried==['p']
+
+    monkeypatch.setattr(provider,'max_model_token',200)
+    provider.query('p')
+    monkeypatch.setattr(provider,'max_tokens',20)
+    provider.query('p')
+    assert queried==['p']*3
+    provider.close()
+
+
+def test_bounded_query_retries_rate_limit_errors(echo_provider,monkeypatch):
+    monkeypatch.setattr(llm_provider,'wait_random_exponential',lambda **kwargs: tenacity.wait_none())
+    attempts=[]
+    async def aquery(prompt):
+        attempts.append(prompt)
+        if len(attempts)<3:
+            raise RateLimitError('rate limited',response=httpx.Response(429,request=httpx.Request('POST','https://api.openai.com')),body=None)
+        return prompt.upper()
+    monkeypatch.setattr(echo_provider,'aquery',aquery)
+
+    async def main():
+        return await echo_provider._bounded_query(asyncio.Semaphore(1),None,'p')
+
+    assert asyncio.run(main())=='P'
+    assert attempts==['p']*3
+
+
+def test_micro_batcher_flushes_full_batch(echo_batch_fn,batch_sizes):
+    #the timeout is far longer than the test, so the batches can only be flushed for being full
+    batcher=MicroBatcher(echo_batch_fn,max_batch_size=2,timeout=30)
+
+    async def main():
+        return await asyncio.gather(*[batcher.submit(f"p{i}") for i in range(4)])
+
+    start=time.monotonic()
+    assert asyncio.run(main())==["P0","P1","P2","P3"]
+    assert batch_sizes==[2,2]
+    assert time.monotonic()-start<5
+
+
+def test_micro_batcher_flushes_lone_prompt_on_timeout(echo_batch_fn,batch_sizes):
+    batcher=MicroBatcher(echo_batch_fn,max_batch_size=8,timeout=0.05)
+
+    start=time.monotonic()
+    assert asyncio.run(batcher.submit("p"))=="P"
+    assert batch_sizes==[1]
+    assert time.monotonic()-start<5
+
+
+def test_micro_batcher_error_reaches_every_caller():
+    def batch_fn(prompts):
+        raise RuntimeError("boom")
+    batcher=MicroBatcher(batch_fn,max_batch_size=3,timeout=30)
+
+    async def main():
+        return await asyncio.gather(*[batcher.submit(f"p{i}") for i in range(3)],return_exceptions=True)
+
+    errors=asyncio.run(main())
+    assert len(errors)==3
+    assert all(isinstance(e,RuntimeError) and str(e)=="boom" for e in errors)
+
+
+def test_micro_batcher_reused_across_event_loops(echo_batch_fn,batch_sizes):
+    batcher=MicroBatcher(echo_batch_fn,max_batch_size=8,timeout=0.01)
+
+    assert asyncio.run(batcher.submit("a"))=="A"
+    assert asyncio.run(batcher.submit("b"))=="B"
+    assert batch_sizes==[1,1]
+
 
-a=LLMProvider(provider='huggingface',prompt_template='Given the salary of {salary}, what is the square of the salary?',
-              hf_model='mistralai/Mathstral-7B-v0.1')
+if __name__=="__main__":
+    a=LLMProvider(provider='huggingface',prompt_template=SALARY_TEMPLATE,
+                  hf_model='mistralai/Mathstral-7B-v0.1')
 
-df=pd.DataFrame({'salary':[2,3,4,5,6],'emp_name':['shrajan','rinith','pradeep','manju','ganesh']})
+    df=pd.DataFrame({'salary':[2,3,4,5,6],'emp_name':['shrajan','rinith','pradeep','manju','ganesh']})
 
-b=a.process_row_by_row(df)
-print(b)
+    b=a.process_row_by_row(df)
+    print(b)